@@ -1,38 +1,67 @@
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta, time
 import functools
+import itertools
 import json
 import logging
-import traceback
+import threading
+from queue import Empty, Queue
 from logging import Logger
 import sys
 from dataclasses import dataclass
+from time import monotonic, sleep
 import pytz
 from telegram import message
 from bidict import bidict
 from telegram.chatinvitelink import ChatInviteLink
 
-from messages_repo import MessagesRepo, MessageEntity
-from typing import Dict, Optional, List, Set, Callable, Any
+from messages_repo import MessagesRepo, MessageEntity, RepoOperation, to_timestamp
+from typing import Dict, Iterator, Optional, List, Set, Callable, Any, Tuple
 
-from telegram import Update, Chat
+from telegram import Update, Chat, Bot
 from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackContext, PicklePersistence, updater
 from telegram.user import User
 from telegram.message import Message
-from telegram.error import (TelegramError, Unauthorized, BadRequest, TimedOut, ChatMigrated, NetworkError)
+from telegram.error import (TelegramError, Unauthorized, BadRequest, TimedOut, ChatMigrated, NetworkError, RetryAfter)
+
+try:
+    # optional faster JSON parser (its JSONDecodeError is a subclass of the standard one)
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level = logging.INFO
 )
 logger: Logger = logging.getLogger(__name__)
 
-@dataclass
+DELETION_BATCH_SIZE: int = 100
+"""Max amount of messages that could be deleted with a single 'deleteMessages' API call."""
+DB_WORKER_BATCH_SIZE: int = 500
+"""Max amount of queued repo operations the DB worker performs at once (see 'CleanerBot._db_worker')."""
+DB_WORKER_BATCH_WINDOW: float = 0.05
+"""Max time (in seconds) the DB worker waits for more operations to perform them at once."""
+GROUP_API_CALL_INTERVAL: float = 60 / 20
+"""Min time (in seconds) between two API calls addressed to the same group during the total cleanup (Telegram allows ~20 messages per minute in a group, see '_throttle_api_call')."""
+PERSISTENCE_FLUSH_INTERVAL: float = 60
+"""Time (in seconds) between two dumps of the bot's persisted data."""
+NETWORK_RETRY_DELAY: float = 1.0
+"""Time (in seconds) to wait before retrying an API call that failed due to network problems."""
+TOTAL_CLEANUP_WORKERS: int = 8
+"""Amount of chats that are cleaned up concurrently during the total cleanup."""
+_UNBATCHED_DB_OPERATIONS: frozenset = frozenset({MessagesRepo.delete_chats_messages})
+"""Long-running repo operations that commit their progress step by step, so the DB worker performs them outside of the batch transaction."""
+_GROUP_TYPES: frozenset = frozenset({Chat.GROUP, Chat.SUPERGROUP})
+"""Chat types the bot is able to cleanup."""
+
+@dataclass(slots=True)
 class Webhook():
     """Webhook configuration"""
     listen: str
     port: int
     webhook_base_url: str
 
-@dataclass
+@dataclass(slots=True)
 class Config():
     """Represents complete bot configuration."""
     bot_token: str
@@ -56,8 +85,9 @@ class Config():
         if self.cleanup_time_str:
             return datetime.strptime(self.cleanup_time_str, '%H:%M').time()
 
+@functools.lru_cache(maxsize=1)
 def load_config(config_path: str) -> Config:
-    """Load and parse bot configuration file."""
+    """Load and parse bot configuration file. Parsed config is cached per config path."""
     config_format_example = """
         {
             "bot_token": "<your_bot_token>",
@@ -71,13 +101,14 @@ def load_config(config_path: str) -> Config:
             "cleanup_time_str": <daily_cleanup_time_UTC>
         }"""
     try:
-        with open(config_path, 'r') as config_file:
-            config_dict = json.load(config_file)
+        with open(config_path, 'rb') as config_file:
+            config_dict = json_loads(config_file.read())
             return Config(**config_dict)
-    except:
-        exception = sys.exc_info()
-        logger.error(f"Failed to init the bot: {exception[0]}. You may check your configuration file - {config_path}. It supposed to have the following format:\n{config_format_example}\n")
-        traceback.print_exc()
+    except json.JSONDecodeError as e:
+        logger.error("Failed to parse the configuration file - %s: %s. It supposed to have the following format:\n%s\n", config_path, e, config_format_example)
+        sys.exit("Failed to init the bot. Please, check your 'config.json' file.")
+    except Exception:
+        logger.exception("Failed to init the bot. You may check your configuration file - %s. It supposed to have the following format:\n%s\n", config_path, config_format_example)
         sys.exit("Failed to init the bot. Please, check your 'config.json' file.")
 
 class CleanerBot:
@@ -88,10 +119,15 @@ class CleanerBot:
         """Initialisation config data."""
         self._messages_repo = MessagesRepo(db_path=config.db_path)
         """Messages storage."""
+        self._db_queue: 'Queue[Tuple[RepoOperation, Dict[str, Any]]]' = Queue()
+        """Repo write operations (with their arguments) waiting to be performed by the DB worker thread (see '_db_worker')."""
+        self._put_db_operation: Callable[[Tuple[RepoOperation, Dict[str, Any]]], None] = self._db_queue.put
+        """Pre-bound 'put' of the DB queue, it is called for every retained message."""
 
         # picke persistance allows to persist dispatcher's 'bot_data', 'user_data' and 'chat_data' dictionaries
-        pickle_persistence = PicklePersistence(filename=config.bot_persistence)
-        self._updater = Updater(token=config.bot_token, persistence=pickle_persistence, user_sig_handler=self._signal_handler, use_context=True)
+        # NOTE: only 'bot_data' is used by the bot; it is dumped periodically (see 'launch') and on shutdown instead of being rewritten on every update
+        self._persistence = PicklePersistence(filename=config.bot_persistence, store_user_data=False, store_chat_data=False, single_file=True, on_flush=True)
+        self._updater = Updater(token=config.bot_token, persistence=self._persistence, user_sig_handler=self._signal_handler, use_context=True)
         
         dispatcher = self._updater.dispatcher
 
@@ -104,6 +140,15 @@ class CleanerBot:
         if 'group_joiner_chats' not in dispatcher.bot_data:
             dispatcher.bot_data['group_joiner_chats'] = bidict()
 
+        # 'bot_data' values are loaded by the persistence at this point and only modified in place afterwards, so it's safe to keep the references
+        self._active_groups_ref: Set[int] = dispatcher.bot_data['active_groups']
+        self._group_joiner_chats_ref: bidict[int, str] = dispatcher.bot_data['group_joiner_chats']
+        self._bot_id: Optional[int] = None
+        """Actual bot user ID, it is received on launch (see 'launch')."""
+        self._next_api_calls: Dict[int, float] = dict()
+        """Time (monotonic) the next API call to the chat is allowed at (see '_throttle_api_call')."""
+        self._next_api_calls_lock = threading.Lock()
+
         # Registration of supported commands
         # NOTE: if message fileters overlap each other, only first handler will be triggered (order defines what is going to be  triggered)
         dispatcher.add_handler(CommandHandler("start", self._start))
@@ -115,10 +160,8 @@ class CleanerBot:
         dispatcher.add_handler(CommandHandler("setup_join_config", self._setup_join_config))
         dispatcher.add_handler(CommandHandler("join", self._join))
         # actual wiping-related functionality
-        dispatcher.add_handler(MessageHandler(Filters.status_update.chat_created, self._chat_created))
-        dispatcher.add_handler(MessageHandler(Filters.status_update.new_chat_members, self._user_added))
-        dispatcher.add_handler(MessageHandler(Filters.status_update.left_chat_member, self._user_removed))
-        dispatcher.add_handler(MessageHandler(Filters.status_update.migrate, self._chat_migrated))
+        # all status updates are handled with a single filter and then delegated to the dedicated handlers (see '_status_dispatch')
+        dispatcher.add_handler(MessageHandler(Filters.status_update, self._status_dispatch))
         dispatcher.add_handler(CommandHandler("cleanup", self._cleanup))
         # common messages callback, that doesn't do much, but keeps incoming messages
         dispatcher.add_handler(MessageHandler(Filters.all, self._receive_incoming_message))
@@ -130,15 +173,17 @@ class CleanerBot:
         # perform get_me() API call, to get actual bot data and check if token is correct
         logger.info("Starting the bot.")
         bot_user: User = self._updater.dispatcher.bot.get_me()
-        logger.info(f"Successfully received bot's user info: {bot_user}.")
-        # keep actual bot name updated, it is used to handle bot addition/kick scenarios (we are using dispatcher's bot_data dictionary to persist some values)
-        self._updater.dispatcher.bot_data['bot_name'] = bot_user.name
+        logger.info("Successfully received bot's user info: %s.", bot_user)
+        # keep actual bot ID, it is used to handle bot addition/kick scenarios (unlike the name, it can't be changed)
+        self._bot_id = bot_user.id
         # start DB session 
         self._messages_repo.init_session()
+        # all repo writes are performed in the background, so the update processing isn't blocked by the DB
+        threading.Thread(target=self._db_worker, name='db_worker', daemon=True).start()
         # start the bot
         if self._config.webhook:
             webhook: Webhook = self._config.webhook
-            logger.info(f"Starting the following webhook: {webhook}")
+            logger.info("Starting the following webhook: %s", webhook)
             bot_token = self._config.bot_token
             self._updater.start_webhook(listen=webhook.listen, port=webhook.port, url_path=bot_token, webhook_url=f"{webhook.webhook_base_url}{bot_token}")
         else:
@@ -148,10 +193,12 @@ class CleanerBot:
         # schedule global cleanup (UTC time) if necessary
         daily_cleanup_time: time = self._config.cleanup_time
         if daily_cleanup_time:
-            logger.info(f"Shcedulling daily cleanup job at {daily_cleanup_time} time, UTC.")
+            logger.info("Shcedulling daily cleanup job at %s time, UTC.", daily_cleanup_time)
             self._updater.dispatcher.job_queue.run_daily(self._perform_total_cleanup, 
                 time(daily_cleanup_time.hour, daily_cleanup_time.minute, tzinfo=pytz.utc))
         # self._updater.dispatcher.job_queue.run_once(self._perform_total_cleanup, 5)
+        # persistence is set up to write the data on flush only, so it has to be flushed from time to time to survive a crash
+        self._updater.dispatcher.job_queue.run_repeating(self._perform_persistence_flush, PERSISTENCE_FLUSH_INTERVAL)
         
         # blocks the execution
         self._updater.idle()
@@ -161,42 +208,130 @@ class CleanerBot:
     @property
     def _active_groups(self) -> Set[int]:
         """Retieves 'active groups' set from the 'bot_data' dictionary that is persisted by the bot (see bot iniitalisation)"""
-        return self._updater.dispatcher.bot_data['active_groups']
+        return self._active_groups_ref
 
     @property
     def _group_joiner_chats(self) -> bidict[int, str]:
         """Retieves 'group joiner chats' dict (chat_id to chat_name) from the 'bot_data' dictionary that is persisted by the bot (see bot iniitalisation)"""
-        return self._updater.dispatcher.bot_data['group_joiner_chats']
+        return self._group_joiner_chats_ref
 
     def _abandon_chat(self, chat_id: int) -> None:
         """Handle all possible situations when the bot can't work with a chat (when getting kicked or chat is deleted, for exammple)"""
-        self._active_groups.discard(chat_id)
-        self._messages_repo.delete_chat_messages(chat_id=chat_id)
-        if chat_id in self._group_joiner_chats:
-            del self._group_joiner_chats[chat_id]
-
-    def _send_status_message(self, chat_id: int, text: str, *args, **kwargs) -> Message:
-        """Use this method to send cleanup status messages. Here we can properly react to possible Unauthorized exceptions (for instance when chat is deleted ot got kicked)"""
+        self._abandon_chats({chat_id})
+
+    def _abandon_chats(self, chat_ids: Set[int]) -> None:
+        """Bulk version of '_abandon_chat': all the chats are forgotten at once."""
+        self._active_groups.difference_update(chat_ids)
+        self._queue_db_operation(MessagesRepo.delete_chats_messages, chat_ids=chat_ids)
+        for chat_id in chat_ids:
+            if chat_id in self._group_joiner_chats:
+                del self._group_joiner_chats[chat_id]
+
+    def _send_status_message(self, chat_id: int, text: str, *args, throttled: bool = False, **kwargs) -> Tuple[Optional[Message], bool]:
+        """Use this method to send cleanup status messages. Here we can properly react to possible Unauthorized exceptions (for instance when chat is deleted ot got kicked).
+        'throttled' tells if the group flood limits have to be respected (see '_throttle_api_call').
+        Returns the sent message and the flag telling if the chat has to be abandoned (the caller is responsible for that, see '_abandon_chats')."""
+        if throttled:
+            self._throttle_api_call(chat_id)
         try:
-            return self._updater.dispatcher.bot.send_message(chat_id=chat_id, text=text, *args, **kwargs)
+            return self._updater.dispatcher.bot.send_message(chat_id=chat_id, text=text, *args, **kwargs), False
         except Unauthorized:
-            logger.error(f"Failed to send a status message to the chat/{chat_id}; removing it.")
-            self._abandon_chat(chat_id=chat_id)
+            logger.error("Failed to send a status message to the chat/%s; removing it.", chat_id)
+            return None, True
 
     def _handle_chat_id_migration(self,old_chat_id: int, new_chat_id: int) -> None:
-        logger.info(f"The chat id has been updated from {old_chat_id} to {new_chat_id}")
+        logger.info("The chat id has been updated from %s to %s", old_chat_id, new_chat_id)
         # update active groups set
         self._active_groups.discard(old_chat_id)
         self._active_groups.add(new_chat_id)
         # message entities should be updated as well
-        self._messages_repo.update_chat_id(original_chat_id=old_chat_id, updated_chat_id=new_chat_id)
+        self._queue_db_operation(MessagesRepo.update_chat_id, original_chat_id=old_chat_id, updated_chat_id=new_chat_id)
 
     def _retain_message(self, message: Message) -> None:
         """Check if the message data (message_id, chat_id, date) should be kept for a further removal"""
-        if message.chat.type in (Chat.GROUP, Chat.SUPERGROUP):
-            logger.info(f"Keeping the message: {message.message_id}")
-            entity = MessageEntity(message_id=message.message_id, chat_id=message.chat_id, timestamp=message.date)
-            self._messages_repo.add_message(entity)
+        if message.chat.type not in _GROUP_TYPES:
+            return
+        logger.info("Keeping the message: %s", message.message_id)
+        entity = MessageEntity(message_id=message.message_id, chat_id=message.chat_id, timestamp=to_timestamp(message.date))
+        self._put_db_operation((MessagesRepo.add_message, {'message': entity}))
+
+    def _queue_db_operation(self, operation: RepoOperation, **kwargs) -> None:
+        """Queue a repo write operation, it is going to be performed by the DB worker thread (see '_db_worker')."""
+        self._put_db_operation((operation, kwargs))
+
+    def _wait_for_db_operations(self) -> None:
+        """Block until all queued repo operations are performed.
+        NOTE: it should be called before any repo read that relies on the queued writes being stored."""
+        self._db_queue.join()
+
+    def _db_worker(self) -> None:
+        """DB worker thread routine. Performs queued repo operations in the order they have been queued."""
+        while True:
+            operations: List[Tuple[RepoOperation, Dict[str, Any]]] = [self._db_queue.get()]
+            # updates usually come in bursts: keep collecting operations for a short while to process the whole burst at once
+            deadline: float = monotonic() + DB_WORKER_BATCH_WINDOW
+            while len(operations) < DB_WORKER_BATCH_SIZE:
+                timeout: float = deadline - monotonic()
+                try:
+                    operations.append(self._db_queue.get(timeout=timeout) if timeout > 0 else self._db_queue.get_nowait())
+                except Empty:
+                    break
+            try:
+                self._perform_db_operations(operations)
+            except Exception:
+                # the worker must keep working no matter what
+                logger.exception("Failed to perform %s queued repo operations.", len(operations))
+            finally:
+                for _ in operations:
+                    self._db_queue.task_done()
+
+    def _perform_db_operations(self, operations: List[Tuple[RepoOperation, Dict[str, Any]]]) -> None:
+        """Perform repo operations in the order they have been queued: consecutive operations are committed at once (see '_perform_db_batch'),
+        while the long-running ones (see '_UNBATCHED_DB_OPERATIONS') are performed on their own."""
+        batch: List[Tuple[RepoOperation, Dict[str, Any]]] = list()
+        for operation, kwargs in operations:
+            if operation in _UNBATCHED_DB_OPERATIONS:
+                self._perform_db_batch(batch)
+                batch = list()
+                self._perform_db_operation(operation, kwargs)
+            else:
+                batch.append((operation, kwargs))
+        self._perform_db_batch(batch)
+
+    def _perform_db_batch(self, operations: List[Tuple[RepoOperation, Dict[str, Any]]]) -> None:
+        """Perform repo operations within a single transaction; consecutive messages additions are written with a single bulk insert.
+        If the transaction fails, the operations are replayed one by one, so only the failing ones are lost."""
+        if not operations:
+            return
+        try:
+            with self._messages_repo.transaction():
+                added_messages: List[MessageEntity] = list()
+                for operation, kwargs in operations:
+                    if operation is MessagesRepo.add_message:
+                        added_messages.append(kwargs['message'])
+                        continue
+                    if added_messages:
+                        self._messages_repo.add_messages(added_messages)
+                        added_messages = list()
+                    operation(self._messages_repo, **kwargs)
+                if added_messages:
+                    self._messages_repo.add_messages(added_messages)
+        except Exception:
+            logger.exception("Failed to perform %s queued repo operations at once. Performing them one by one.", len(operations))
+            for operation, kwargs in operations:
+                self._perform_db_operation(operation, kwargs)
+
+    def _perform_db_operation(self, operation: RepoOperation, kwargs: Dict[str, Any]) -> None:
+        """Perform a single repo operation on its own; failures are only logged, so other operations are still performed."""
+        try:
+            if operation in _UNBATCHED_DB_OPERATIONS:
+                # it commits its progress on its own
+                operation(self._messages_repo, **kwargs)
+                return
+            with self._messages_repo.transaction():
+                operation(self._messages_repo, **kwargs)
+        except Exception:
+            logger.exception("Failed to perform queued repo operation '%s' (%s).", operation.__name__, kwargs)
 
     @property
     def _deletion_limit(self) -> datetime:
@@ -206,29 +341,35 @@ class CleanerBot:
 
     class Decorators:
         """Declare all internal bot-related decorators here."""
+        @staticmethod
+        def _call_and_keep(callback: Callable[['CleanerBot', Update, CallbackContext], Any], self: 'CleanerBot', update: Update, context: CallbackContext) -> Any:
+            """Calls the handler callback and saves its incoming and outcoming (if presented) messages into the repo."""
+            retain: Callable[[Message], None] = self._retain_message
+            retain(update.message)
+
+            out_message = callback(self, update, context)
+            if isinstance(out_message, Message):
+                retain(out_message)
+
+            return out_message
+
         @classmethod
         def keep_callback_messages(cls, callback: Callable[['CleanerBot', Update, CallbackContext], Any]) -> Callable[['CleanerBot', Update, CallbackContext], Any]:
             """Applied to a handler callbacks this decorator automatically saves incoming and outcoming (if presented) messages into the repo."""
             @functools.wraps(callback)
             def wrap(self: 'CleanerBot', update: Update, context: CallbackContext) -> Message: 
-                in_message: Message = update.message
-                self._retain_message(in_message)
-
-                out_message = callback(self, update, context)
-                if isinstance(out_message, Message):
-                    self._retain_message(out_message)
-
-                return out_message
+                return cls._call_and_keep(callback, self, update, context)
             return wrap
 
         @classmethod
-        def log_messages(cls, callback: Callable[['CleanerBot', Update, CallbackContext], Any]) -> Callable[['CleanerBot', Update, CallbackContext], Any]:
-            """Applied to a handler callbacks this decorator automatically logs all incoming and outcomming messages."""
+        def keep_and_log(cls, callback: Callable[['CleanerBot', Update, CallbackContext], Any]) -> Callable[['CleanerBot', Update, CallbackContext], Any]:
+            """Same as 'keep_callback_messages', but all incoming and outcomming messages are logged as well."""
             @functools.wraps(callback)
             def wrap(self: 'CleanerBot', update: Update, context: CallbackContext) -> Message: 
                 in_message: Message = update.message
-                out_message = callback(self, update, context)
-                logger.info(f"Callback log: {callback.__name__}.\nInc. message:\n{in_message}.\nOut. message:\n{out_message}.\n")
+                out_message = cls._call_and_keep(callback, self, update, context)
+                if logger.isEnabledFor(logging.INFO):
+                    logger.info("Callback log: %s.\nInc. message:\n%s.\nOut. message:\n%s.\n", callback.__name__, in_message, out_message)
                 return out_message
             return wrap
         
@@ -271,28 +412,25 @@ class CleanerBot:
         bot_data: str = str(context.bot_data)
         return update.message.reply_text(text=bot_data, reply_to_message_id=update.message.message_id)
 
-    @Decorators.log_messages
-    @Decorators.keep_callback_messages
+    @Decorators.keep_and_log
     def _receive_incoming_message(self, update: Update, context: CallbackContext) -> None:
         """Simple callback that receives and stores it's message."""
         pass
 
     # joining-related handlers
     # TODO rework & refactor all join funct
-    @Decorators.log_messages
-    @Decorators.keep_callback_messages
+    @Decorators.keep_and_log
     def _setup_join_config(self, update: Update, context: CallbackContext) -> Message:
         """Adds join mapping for the group."""
         message: Message = update.message
         chat_id = message.chat_id
-        if message.chat.type not in (Chat.GROUP, Chat.SUPERGROUP):
+        if message.chat.type not in _GROUP_TYPES:
             return message.reply_text('This command is not supposed to work here.')
 
-        command_segments: List[str] = message.text.split()
-        if len(command_segments) >= 2:
-            command_length: int = len(command_segments[0])
-            message_length: int = len(message.text)
-            chat_name: str = message.text[command_length:message_length].strip()
+        # everything after the command (separated by any whitespace) is considered to be a chat name
+        command_segments: List[str] = message.text.split(maxsplit=1)
+        chat_name: str = command_segments[1].strip() if len(command_segments) > 1 else ''
+        if chat_name:
             is_taken: bool = chat_name in self._group_joiner_chats.inverse
             if is_taken:
                 name_owner_id: int = self._group_joiner_chats.inverse[chat_name]
@@ -312,11 +450,9 @@ class CleanerBot:
     def _join(self, update: Update, context: CallbackContext) -> Message:
         """Join the group."""
         message: Message = update.message
-        command_segments: List[str] = message.text.split()
-        if len(command_segments) >= 2:
-            command_length: int = len(command_segments[0])
-            message_length: int = len(message.text)
-            chat_name: str = message.text[command_length:message_length].strip()
+        command_segments: List[str] = message.text.split(maxsplit=1)
+        chat_name: str = command_segments[1].strip() if len(command_segments) > 1 else ''
+        if chat_name:
             if chat_name in self._group_joiner_chats.inverse:
                 joining_chat_id = self._group_joiner_chats.inverse[chat_name]
                 try:
@@ -324,7 +460,7 @@ class CleanerBot:
                     invite_link: ChatInviteLink = context.bot.create_chat_invite_link(chat_id=joining_chat_id, expire_date=expire_date)
                     update.message.reply_text(text=f"Here is your invite link: {invite_link.invite_link}", reply_to_message_id=update.message.message_id) 
                 except BadRequest:
-                    logger.error(f"Got 'BadRequest' exception during invite link creation. Most likely due to 'missing rights'.")
+                    logger.error("Got 'BadRequest' exception during invite link creation. Most likely due to 'missing rights'.")
                     update.message.reply_text(text=f"Failed to create the link.", reply_to_message_id=update.message.message_id)  
             else:
                 return update.message.reply_text(text=f"Can't find the chat.", reply_to_message_id=update.message.message_id)
@@ -333,10 +469,24 @@ class CleanerBot:
             return update.message.reply_text(text=f"Not enough arguments.", reply_to_message_id=update.message.message_id)
 
     # wiping-related handlers  
+    def _status_dispatch(self, update: Update, context: CallbackContext) -> Optional[Message]:
+        """Handles all status updates: delegates them to the corresponding handler based on the message content."""
+        message: Message = update.effective_message
+        if message.group_chat_created or message.supergroup_chat_created or message.channel_chat_created:
+            return self._chat_created(update, context)
+        if message.new_chat_members:
+            return self._user_added(update, context)
+        if message.left_chat_member:
+            return self._user_removed(update, context)
+        if message.migrate_to_chat_id or message.migrate_from_chat_id:
+            return self._chat_migrated(update, context)
+        # other status updates (title changes, pinned messages, etc.) are kept just like any other message
+        return self._receive_incoming_message(update, context)
+
     def _chat_migrated(self, update: Update, context: CallbackContext) -> None: 
         """Handles chat_id change update."""
         logger.info(update.message)
-        if update.message.chat.type in (Chat.GROUP, Chat.SUPERGROUP):
+        if update.message.chat.type in _GROUP_TYPES:
             message: Message = update.message
             # that's how IDs should be settled according to the docs (https://github.com/python-telegram-bot/python-telegram-bot/wiki/Storing-bot,-user-and-chat-related-data)
             # NOTE: this callback is triggered twice during a single chat ID migration:
@@ -350,97 +500,181 @@ class CleanerBot:
     def _chat_created(self, update: Update, context: CallbackContext) -> Message:
         """New group chat've been created with this bot as one of the initial members.""" 
         # if update.effective_chat.type in (Chat.GROUP, Chat.SUPERGROUP): # no need to check this here: the event itself implies that it could only be a common group (see docs.)
-        logger.info(f"New group chat've been created with this bot as one of the initial members: {update.effective_chat.title}")
+        logger.info("New group chat've been created with this bot as one of the initial members: %s", update.effective_chat.title)
         self._active_groups.add(update.effective_chat.id)
         return context.bot.send_message(update.effective_chat.id, "Hello, this is a (*group) chat cleaning bot. Please, use /help command to get more info.")
 
     @Decorators.keep_callback_messages
     def _user_added(self, update: Update, context: CallbackContext) -> Optional[Message]:
         """This bot've been added to a group chat.""" 
-        if update.effective_chat.type in (Chat.GROUP, Chat.SUPERGROUP):
+        if update.effective_chat.type in _GROUP_TYPES:
             new_users: List[User] = update.message.new_chat_members
             for user in new_users:
-                if user.name == context.bot_data['bot_name']:
-                    logger.info(f"Bot has beed added to the (super)group: '{update.effective_chat.title}'.")
+                if user.id == self._bot_id:
+                    logger.info("Bot has beed added to the (super)group: '%s'.", update.effective_chat.title)
                     self._active_groups.add(update.effective_chat.id)
                     return context.bot.send_message(update.effective_chat.id, "Hello, this is a (*group) chat cleaning bot. Please, use /help command to get more info.")
 
     @Decorators.keep_callback_messages
     def _user_removed(self, update: Update, context: CallbackContext) -> None:
         """This bot've been removed from the group chat."""
-        if update.effective_chat.type in (Chat.GROUP, Chat.SUPERGROUP):
+        if update.effective_chat.type in _GROUP_TYPES:
             removed_user: User = update.message.left_chat_member
-            if removed_user.name == context.bot_data['bot_name']:
-                logger.info(f"Bot has beed removed from the (super)group: '{update.effective_chat.title}'.")
+            if removed_user.id == self._bot_id:
+                logger.info("Bot has beed removed from the (super)group: '%s'.", update.effective_chat.title)
                 self._abandon_chat(chat_id=update.effective_chat.id)
 
     @Decorators.keep_callback_messages
     def _cleanup(self, update: Update, context: CallbackContext) -> None:
         """Delete all recent messages from this chat"""
         message: Message = update.message
-        if message.chat.type in (Chat.GROUP, Chat.SUPERGROUP):
+        if message.chat.type in _GROUP_TYPES:
             context.job_queue.run_once(self._perform_chat_cleanup, 2, context=message.chat_id)
         else:
             message.reply_text('This command is not supposed to work here. Use /help to get more info.')
 
     # cleanup methods
-    def _chat_cleanup(self, context: CallbackContext, chat_id: int) -> None:
-        """Wipe all recent (see /restrictions) messages for the chat and send the report."""
-        logger.info(f"Initiated chat ({chat_id}) cleanup.")
-        deletion_threshold: datetime = self._deletion_limit
-        recent_messages: List[Message] = self._messages_repo.get_chat_messages(chat_id, deletion_threshold)
-        deleted_messages: List[Message] = list()
-        unauthorized: bool = False
-        for message_entity in recent_messages:
+    def _delete_messages(self, bot: Bot, chat_id: int, message_ids: List[int]) -> bool:
+        """Delete several messages of the chat with a single API call (see https://core.telegram.org/bots/api#deletemessages)."""
+        if hasattr(bot, 'delete_messages'):
+            return bot.delete_messages(chat_id=chat_id, message_ids=message_ids)
+        # older python-telegram-bot versions (v13) have no wrapper for 'deleteMessages', so the raw request is posted
+        return bot.request.post(f"{bot.base_url}/deleteMessages", {'chat_id': chat_id, 'message_ids': message_ids})
+
+    def _throttle_api_call(self, chat_id: int) -> None:
+        """Block until the next API call to the chat is allowed: respect the group flood limits (see 'GROUP_API_CALL_INTERVAL').
+        Chats are cleaned up concurrently during the total cleanup (see '_perform_total_cleanup'), so their batch deletions and status messages are throttled, each chat on its own.
+        NOTE: one-by-one deletions and retries are not throttled: flood control is handled with 'RetryAfter' (see '_call_with_retry')."""
+        with self._next_api_calls_lock:
+            now: float = monotonic()
+            call_time: float = max(now, self._next_api_calls.get(chat_id, now))
+            # the time slot is reserved before sleeping, so concurrent calls to the same chat are spaced as well
+            self._next_api_calls[chat_id] = call_time + GROUP_API_CALL_INTERVAL
+        if call_time > now:
+            sleep(call_time - now)
+
+    def _call_with_retry(self, call: Callable[[], Any]) -> Any:
+        """Perform the API call; it is retried after the requested delay in case of flood control
+        and once after a short delay in case of network problems."""
+        network_retried: bool = False
+        while True:
+            try:
+                return call()
+            except RetryAfter as e:
+                logger.warning("Flood control exceeded. Retrying in %s seconds.", e.retry_after)
+                sleep(e.retry_after)
+            except BadRequest:
+                # 'BadRequest' is a subclass of 'NetworkError', but there is no point to retry it
+                raise
+            except (NetworkError, TimedOut) as e:
+                if network_retried:
+                    raise
+                network_retried = True
+                logger.warning("API call failed: %s. Retrying in %s seconds.", e, NETWORK_RETRY_DELAY)
+                sleep(NETWORK_RETRY_DELAY)
+
+    def _delete_batch(self, context: CallbackContext, chat_id: int, batch: List[int], throttled: bool = False) -> Tuple[List[int], bool]:
+        """Delete a batch of messages (by their IDs); 'throttled' tells if the batch API call has to respect the group flood limits (see '_throttle_api_call').
+        Returns IDs of the ones that have been deleted and the flag telling if the deletion has been stopped due to 'Unauthorized' exception
+        (the whole cleanup has to be stopped in this case)."""
+        if throttled:
+            self._throttle_api_call(chat_id)
+        try:
+            deleted: bool = self._call_with_retry(lambda: self._delete_messages(context.bot, chat_id=chat_id, message_ids=batch))
+            return (batch if deleted else list()), False
+        except Unauthorized:
+            return list(), True
+        except BadRequest as e:
+            # the batch can't be deleted as a whole (some messages are too old, for instance), so fall back to one-by-one deletion
+            logger.warning("Batch deletion of %s messages failed: %s. Deleting them one by one.", len(batch), e)
+        except TelegramError:
+            logger.exception("Failed to delete a batch of %s messages of the chat/%s.", len(batch), chat_id)
+            return list(), False
+
+        deleted_message_ids: List[int] = list()
+        for message_id in batch:
             deleted: bool = False
             try:
-                deleted = context.bot.delete_message(chat_id=chat_id, message_id=message_entity.message_id)
+                deleted = self._call_with_retry(lambda: context.bot.delete_message(chat_id=chat_id, message_id=message_id))
             except Unauthorized:
-                # most likely bot has been kicked or chat is deleted
-                logger.error(f"Got 'Unauthorised' exception during a message deletion. Stopping deletion job.")
-                unauthorized = True
-                break
-            except:
-                # TODO should we add some praticular exceptions handling here, like BadReuest (could be triggered if there is no rights for deletion) or Unauthorized (removed from the chat)
-                exception = sys.exc_info()
-                logger.error(f"Failed to perform message deletion API call for the following message: {message_entity}. {exception[0]}")
-                traceback.print_exc()
-                
-            
+                # messages deleted so far are still reported, so they're removed from the repo as well
+                return deleted_message_ids, True
+            except BadRequest as e:
+                # most likely there are no rights for deletion or the message is too old
+                logger.warning("Deletion failed for the message %s of the chat/%s: %s", message_id, chat_id, e)
+            except TelegramError:
+                logger.exception("Failed to delete the message %s of the chat/%s.", message_id, chat_id)
+
             if deleted:
-                deleted_messages.append(message_entity)
-                self._messages_repo.remove_message(message_entity) # TODO add some sort of bulk deletion in the end? not sure if it is possible though
-        
-        if unauthorized:
-            self._abandon_chat(chat_id=chat_id)
-            return
+                deleted_message_ids.append(message_id)
+        return deleted_message_ids, False
+
+    def _chat_cleanup(self, context: CallbackContext, chat_id: int, deletion_threshold: Optional[datetime] = None, throttled: bool = False) -> Tuple[int, bool]:
+        """Wipe all recent (see /restrictions) messages for the chat and send the report.
+        'deletion_threshold' allows to share the same deletion limit between several chats cleanup (see '_deletion_limit').
+        'throttled' tells if the API calls have to respect the group flood limits (see '_throttle_api_call').
+        Returns the chat ID and the flag telling if the chat has to be abandoned (the caller is responsible for that, see '_abandon_chats')."""
+        logger.info("Initiated chat (%s) cleanup.", chat_id)
+        deletion_threshold = deletion_threshold or self._deletion_limit
+        self._wait_for_db_operations()
+        # only IDs are required for the deletion
+        recent_messages: Iterator[int] = self._messages_repo.get_chat_message_ids(chat_id, deletion_threshold)
+        fetched_count: int = 0
+        deleted_count: int = 0
+        while batch := list(itertools.islice(recent_messages, DELETION_BATCH_SIZE)):
+            fetched_count += len(batch)
+            deleted_batch, unauthorized = self._delete_batch(context, chat_id, batch, throttled)
+            if deleted_batch:
+                deleted_count += len(deleted_batch)
+                self._queue_db_operation(MessagesRepo.remove_messages, message_ids=deleted_batch)
+            if unauthorized:
+                # most likely bot has been kicked or chat is deleted
+                logger.error("Got 'Unauthorised' exception during a message deletion. Stopping deletion job.")
+                return chat_id, True
 
-        fails_count : int = len(recent_messages) - len(deleted_messages) 
-        report_message: str = f"Removed {len(deleted_messages)} recent messages. Failed to remove: {fails_count}."
+        fails_count : int = fetched_count - deleted_count
+        report_message: str = f"Removed {deleted_count} recent messages. Failed to remove: {fails_count}."
         logger.info(report_message)
-        message = self._send_status_message(chat_id=chat_id, text=report_message, disable_notification=True)
-        self._retain_message(message)
+        message, abandoned = self._send_status_message(chat_id=chat_id, text=report_message, throttled=throttled, disable_notification=True)
+        if message:
+            self._retain_message(message)
+        return chat_id, abandoned
 
     def _perform_chat_cleanup(self, context: CallbackContext) -> None:
         """A job queue function. Wipes all recent (see /restrictions) messages for a specific chat and sends a report."""
         chat_id: int = context.job.context
-        self._chat_cleanup(context, chat_id)
+        _, abandoned = self._chat_cleanup(context, chat_id)
+        if abandoned:
+            self._abandon_chat(chat_id=chat_id)
+
+    def _perform_persistence_flush(self, context: CallbackContext) -> None:
+        """A job queue function. Dumps the bot's persisted data."""
+        self._persistence.flush()
 
     def _perform_total_cleanup(self, context: CallbackContext) -> None:
         """A job queue function. Wipes all recent (see /restrictions) messages for every (!) active chat."""
         # making a copy of the set, because the origianl one may be modified (removing items) during the iteration (# TODO is it right way to solve this issue?)
         active_groups: Set[int] = self._active_groups.copy()
-        for group_chat_id in active_groups:
-            try:
-                self._chat_cleanup(context, group_chat_id)
-            except:
-                # TODO emprove error handling
-                exception = sys.exc_info()
-                logger.error(f"Failed to perform chat/{group_chat_id} cleanup: {exception[0]}. Continuing to work on other chats cleanup.")
-                traceback.print_exc()
-        
+        # the same limit is used for the whole cleanup, so it doesn't drift while large amount of chats is being processed
+        deletion_threshold: datetime = self._deletion_limit
+        # chats that can't be cleaned up anymore are collected and abandoned all together after the cleanup
+        abandoned_chats: Set[int] = set()
+        # flood limits are applied per chat, so different chats could be safely cleaned up in parallel
+        with ThreadPoolExecutor(max_workers=TOTAL_CLEANUP_WORKERS, thread_name_prefix='total_cleanup') as executor:
+            futures: Dict[Future, int] = {executor.submit(self._chat_cleanup, context, group_chat_id, deletion_threshold, True): group_chat_id for group_chat_id in active_groups}
+            for future in as_completed(futures):
+                group_chat_id: int = futures[future]
+                try:
+                    chat_id, abandoned = future.result()
+                    if abandoned:
+                        abandoned_chats.add(chat_id)
+                except Exception:
+                    logger.exception("Failed to perform chat/%s cleanup. Continuing to work on other chats cleanup.", group_chat_id)
+        if abandoned_chats:
+            self._abandon_chats(abandoned_chats)
+
         #at the end of a global cleanup remove outdated messages
-        self._messages_repo.remove_outdated_messages(self._deletion_limit)
+        self._queue_db_operation(MessagesRepo.remove_outdated_messages, date=deletion_threshold)
 
     # Sidenotes about some common "exceptional" scenarios:
     # telegram.error.Unauthorised exception could be triggered when addressee chat is deleted or 
@@ -451,7 +685,7 @@ class CleanerBot:
         NOTE: if the error is being triggered outside of a handler callback
         (during some queued job execution, for instance) 'update' argument may be None"""
         
-        logger.error(f"Error: {context.error}, {type(context.error)}")
+        logger.error("Error: %s, %s", context.error, type(context.error))
         try:
             raise context.error
         except ChatMigrated as e:
@@ -479,7 +713,8 @@ class CleanerBot:
 
     def _signal_handler(self, signum, frame) -> None:
         """Handle system signals. In theory that's where we should close DB-connection and other shutdown-related tasks."""
-        logger.info(f"Handling signal: {signum}.")
+        logger.info("Handling signal: %s.", signum)
+        self._wait_for_db_operations()
         self._messages_repo.close_session()
         
 
@@ -1,28 +1,64 @@
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm.scoping import scoped_session
-from typing import Any, Callable, Optional, Protocol, Tuple, List
+from typing import Any, Callable, Collection, Iterator, Optional, Protocol, Tuple, List, Union
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, String, DATETIME, func
-from sqlalchemy import create_engine
+from sqlalchemy import BigInteger, Column, Index, Integer, String, text
+from sqlalchemy import bindparam, create_engine, delete, event, select, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.sql.expression import Executable
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+import calendar
 import logging
+import sqlite3
+from contextlib import closing, contextmanager
+from datetime import datetime
+from time import monotonic, time
 from sqlalchemy.orm.session import Session
 
-from sqlalchemy.sql.sqltypes import DateTime
-
 logger = logging.getLogger(__name__)
 
 Base = declarative_base()
 
+CHAT_IDS_CACHE_TTL: float = 60
+"""Time (in seconds) 'get_all_chat_ids' result is cached for (unless the repo is modified)."""
+_TRANSACTION_SCOPE_KEY: str = 'messages_repo_transaction'
+"""'Session.info' key marking the session that is inside of the 'MessagesRepo.transaction' scope."""
+DELETION_CHUNK_SIZE: int = 5000
+"""Max amount of messages deleted within a single transaction by 'MessagesRepo.delete_chats_messages'."""
+_INTEGER_TIMESTAMPS_SCHEMA_VERSION: int = 1
+"""DB 'user_version' telling that the stored timestamps have been migrated to integers (see 'MessagesRepo.init_session')."""
+SQLITE_MAX_VARIABLES: int = 900
+"""Max amount of bound parameters used within a single statement (SQLite's default SQLITE_MAX_VARIABLE_NUMBER is 999 for older versions)."""
+
+Timestamp = Union[datetime, int]
+"""Message timestamps are stored as Unix epoch seconds, but repo methods accept datetimes as well (see 'to_timestamp')."""
+
+def to_timestamp(date: Timestamp) -> int:
+    """Converts the datetime into Unix epoch seconds (naive datetimes are considered to be UTC)."""
+    if isinstance(date, datetime):
+        return calendar.timegm(date.utctimetuple())
+    return date
+
 class MessageEntity(Base):
     """Represents message db-entity. Does not contain actual content - only message_id,
     chat_id and timestamp are stored"""
     
     __tablename__ = 'messages'
+    __table_args__ = (
+        # 'get_chat_messages': filter by chat and ordering by timestamp within a single index range scan
+        Index('ix_messages_chat_ts', 'chat_id', 'timestamp'),
+        # 'remove_outdated_messages'
+        Index('ix_messages_ts', 'timestamp'),
+        # the table is clustered by the primary key, so there is no separate rowid and PK index
+        {'sqlite_with_rowid': False},
+    )
 
-    message_id = Column(Integer, primary_key = True)
-    chat_id = Column(Integer)
-    timestamp = Column(DATETIME, default=func.now())
+    # Telegram IDs may exceed 32-bit range (supergroups and channels, for instance)
+    message_id = Column(BigInteger, primary_key = True)
+    chat_id = Column(BigInteger)
+    timestamp = Column(Integer, default=lambda: int(time()))
+    """Unix epoch seconds: smaller rows and plain integer comparisons in range filters."""
 
     def __repr__(self):
         return "<MessageEntity(message_id={message_id}, chat_id={chat_id}, timestamp={timestamp})>"\
@@ -32,9 +68,44 @@ class MessageEntity(Base):
 # Sidenotes about some common "exceptional" scenarios:
 # sqlalchemy.exc.IntegrityError is triggerd whe the entity with the same primary key is presented.
 
+# Raw SQL for the hot paths (messages addition and recent messages reading): it is executed right on the DBAPI connection (see 'MessagesRepo._raw_cursor')
+_UPSERT_MESSAGE_SQL: str = "INSERT INTO messages (message_id, chat_id, timestamp) VALUES (?, ?, ?) "\
+    "ON CONFLICT (message_id) DO UPDATE SET chat_id = excluded.chat_id, timestamp = excluded.timestamp"
+_SELECT_RECENT_CHAT_MESSAGES_SQL: str = "SELECT message_id, chat_id, timestamp FROM messages WHERE chat_id = ? AND timestamp > ? "\
+    "ORDER BY timestamp DESC, message_id DESC LIMIT ?"
+_SELECT_NEXT_RECENT_CHAT_MESSAGES_SQL: str = "SELECT message_id, chat_id, timestamp FROM messages WHERE chat_id = ? AND timestamp > ? AND (timestamp, message_id) < (?, ?) "\
+    "ORDER BY timestamp DESC, message_id DESC LIMIT ?"
+# 'get_chat_message_ids' selects only what is required for the deletion and keyset pagination (served by 'ix_messages_chat_ts' alone)
+_SELECT_RECENT_CHAT_MESSAGE_IDS_SQL: str = "SELECT message_id, timestamp FROM messages WHERE chat_id = ? AND timestamp > ? "\
+    "ORDER BY timestamp DESC, message_id DESC LIMIT ?"
+_SELECT_NEXT_RECENT_CHAT_MESSAGE_IDS_SQL: str = "SELECT message_id, timestamp FROM messages WHERE chat_id = ? AND timestamp > ? AND (timestamp, message_id) < (?, ?) "\
+    "ORDER BY timestamp DESC, message_id DESC LIMIT ?"
+
+# Statements below are built once and executed with bound parameters, so they are compiled only once as well (see SQLAlchemy's compiled cache)
+_DELETE_CHATS_MESSAGES_CHUNK = delete(MessageEntity).where(MessageEntity.message_id.in_(
+    select(MessageEntity.message_id).where(MessageEntity.chat_id.in_(bindparam('chat_ids', expanding=True))).limit(DELETION_CHUNK_SIZE)))
+_UPDATE_CHAT_ID = update(MessageEntity).where(MessageEntity.chat_id == bindparam('original_chat_id')).values(chat_id=bindparam('updated_chat_id'))
+_DELETE_OUTDATED_MESSAGES = delete(MessageEntity).where(MessageEntity.timestamp < bindparam('date'))
+
+def _tune_sqlite_connection(dbapi_connection, connection_record) -> None:
+    """Applies SQLite settings to every new DB connection: WAL journal (readers do not block the writer and vice versa),
+    fewer fsyncs and bigger in-memory caches."""
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA cache_size=-65536")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.close()
+
 class RepoOperation(Protocol):
         def __call__(self, repo: 'MessagesRepo', **kwargs) -> Any: ...
 
+def _message_row(message: MessageEntity) -> Tuple[int, int, int]:
+    """(message_id, chat_id, timestamp) row for the raw SQL; missing timestamp is set just like the column default does."""
+    timestamp: Optional[int] = message.timestamp
+    return message.message_id, message.chat_id, timestamp if timestamp is not None else int(time())
+
 class MessagesRepo:
     """Basically, it is a DAO class representing messages DB-storage.
     Note: 'init_session' should be called before all other access-related methods are called."""
@@ -42,42 +113,168 @@ class MessagesRepo:
     def __init__(self, db_path: String):
         self.db_path = db_path
         self.session : Optional[Session] = None
+        self.engine : Optional[Engine] = None
+        self._chat_ids_cache: Optional[Tuple[float, List[int]]] = None
+        """Cached 'get_all_chat_ids' result along with the time it has been received at (see 'CHAT_IDS_CACHE_TTL')."""
+        self._chat_ids_generation: int = 0
+        """Incremented on every cache invalidation, so a result read before a concurrent modification is not cached."""
 
     def init_session(self) -> None:
-        engine = create_engine("sqlite:///{sqlite_filepath}".format(sqlite_filepath=self.db_path), echo=True)
-        self.session = scoped_session(sessionmaker())
-        self.session.configure(bind=engine)
+        # the repo is used from several threads (handlers, jobs, DB worker), so connections are pooled and may be shared between threads
+        self.engine = engine = create_engine("sqlite:///{sqlite_filepath}".format(sqlite_filepath=self.db_path), echo=False,
+            connect_args={'check_same_thread': False}, poolclass=QueuePool, pool_size=5, max_overflow=10, query_cache_size=1200)
+        event.listen(engine, 'connect', _tune_sqlite_connection)
+        # every thread gets its own session; committed entities stay usable without being reloaded
+        # NOTE: autoflush is disabled, since all writes are committed (or executed) explicitly - reads never have to flush anything first;
+        # use 'session.no_autoflush'/'session.flush' explicitly if a read ever relies on pending ORM changes
+        self.session = scoped_session(sessionmaker(bind=engine, autoflush=False, expire_on_commit=False))
         Base.metadata.create_all(engine)
+        # 'create_all' doesn't add indexes to already existing tables, so they are checked separately
+        for index in MessageEntity.__table__.indexes:
+            index.create(bind=engine, checkfirst=True)
+        # databases created before timestamps became integers keep them as ISO-8601 strings (DATETIME column affinity allows to store integers in place)
+        # NOTE: the migration is a full table scan, so it's performed only once (tracked with the DB 'user_version')
+        with engine.begin() as connection:
+            if connection.exec_driver_sql("PRAGMA user_version").scalar() < _INTEGER_TIMESTAMPS_SCHEMA_VERSION:
+                connection.execute(text("UPDATE messages SET timestamp = CAST(strftime('%s', timestamp) AS INTEGER) WHERE typeof(timestamp) = 'text'"))
+                connection.exec_driver_sql(f"PRAGMA user_version = {_INTEGER_TIMESTAMPS_SCHEMA_VERSION}")
     
     def close_session(self) -> None:
         self.session.close()
 
-    def get_chat_messages(self, chat_id: int, min_timestamp: DateTime) -> List[MessageEntity]:
-        return self.session.query(MessageEntity).order_by(MessageEntity.timestamp.desc()).filter(MessageEntity.chat_id == chat_id, MessageEntity.timestamp > min_timestamp).all()
+    def get_chat_messages(self, chat_id: int, min_timestamp: Timestamp, page_size: int = 1000) -> Iterator[MessageEntity]:
+        """Yields chat messages that are more recent than 'min_timestamp' (most recent first).
+        Messages are fetched page by page (keyset pagination), so memory usage doesn't depend on the amount of messages
+        and no DB cursor is kept open between the pages (the messages may be removed while they're being iterated)."""
+        rows = self._iterate_recent_chat_rows(_SELECT_RECENT_CHAT_MESSAGES_SQL, _SELECT_NEXT_RECENT_CHAT_MESSAGES_SQL, chat_id, min_timestamp, page_size)
+        return (MessageEntity(message_id=message_id, chat_id=chat_id, timestamp=timestamp) for (message_id, chat_id, timestamp) in rows)
+
+    def get_chat_message_ids(self, chat_id: int, min_timestamp: Timestamp, page_size: int = 1000) -> Iterator[int]:
+        """Same as 'get_chat_messages', but only message IDs are fetched (no entities are built)."""
+        rows = self._iterate_recent_chat_rows(_SELECT_RECENT_CHAT_MESSAGE_IDS_SQL, _SELECT_NEXT_RECENT_CHAT_MESSAGE_IDS_SQL, chat_id, min_timestamp, page_size)
+        return (message_id for (message_id, _) in rows)
+
+    def _iterate_recent_chat_rows(self, first_page_sql: str, next_page_sql: str, chat_id: int, min_timestamp: Timestamp, page_size: int) -> Iterator[Tuple]:
+        """Pages through rows of the chat messages that are more recent than 'min_timestamp'.
+        Rows selected by the given SQL have to start with 'message_id' and end with 'timestamp' (the keyset the next page starts after)."""
+        min_timestamp = to_timestamp(min_timestamp)
+        page: List[Tuple] = self._fetch_page(first_page_sql, (chat_id, min_timestamp, page_size))
+        while page:
+            yield from page
+            if len(page) < page_size:
+                return
+            last_row: Tuple = page[-1]
+            page = self._fetch_page(next_page_sql, (chat_id, min_timestamp, last_row[-1], last_row[0], page_size))
+
+    def _fetch_page(self, sql: str, params: Tuple) -> List[Tuple]:
+        with closing(self._raw_cursor()) as cursor:
+            page: List[Tuple] = cursor.execute(sql, params).fetchall()
+        # release the connection back to the pool between the pages (reads may be performed from many threads, see 'CleanerBot._perform_total_cleanup')
+        if not self._in_transaction_scope():
+            self.session.commit()
+        return page
     
-    def delete_chat_messages(self, chat_id: int) -> None:
-        self.session.query(MessageEntity).filter(MessageEntity.chat_id==chat_id).delete(synchronize_session=False)
-        self.session.commit()
+    # NOTE: pure maintenance writes below are performed with Core statements (no Session unit-of-work overhead, see '_execute_write')
+    def delete_chats_messages(self, chat_ids: Collection[int]) -> None:
+        """Deletes all messages of all the given chats chunk by chunk: each chunk is deleted within its own short transaction,
+        so huge chats don't keep the DB write-locked for the whole deletion.
+        NOTE: inside of the 'transaction' scope all the chunks are committed at once, so it should be called outside of it."""
+        chat_ids = list(chat_ids)
+        for i in range(0, len(chat_ids), SQLITE_MAX_VARIABLES):
+            params: dict = {'chat_ids': chat_ids[i:i + SQLITE_MAX_VARIABLES]}
+            while self._execute_write(_DELETE_CHATS_MESSAGES_CHUNK, params) >= DELETION_CHUNK_SIZE:
+                pass
     
     def add_message(self, message: MessageEntity) -> None:
-        # self.session.add(message) # TODO should we use add with the possibility to have catch IntegrityError here (in case if the message is already presented in the repo)?
-        self.session.merge(message)
-        self.session.commit()
-    
+        """Adds the message or updates the stored one (single upsert statement, no SELECT like 'merge' does)."""
+        with closing(self._raw_cursor()) as cursor:
+            cursor.execute(_UPSERT_MESSAGE_SQL, _message_row(message))
+        self._commit()
+
+    def add_messages(self, messages: List[MessageEntity]) -> None:
+        """Bulk version of 'add_message': all the given messages are upserted within a single transaction."""
+        with closing(self._raw_cursor()) as cursor:
+            cursor.executemany(_UPSERT_MESSAGE_SQL, [_message_row(m) for m in messages])
+        self._commit()
+
     def remove_message(self, message: MessageEntity) -> None:
-        self.session.delete(message)
-        self.session.commit()
+        """Removes the message by its primary key: entities built by 'get_chat_messages' aren't attached to the session."""
+        self.remove_messages([message.message_id])
+
+    def remove_messages(self, message_ids: List[int]) -> None:
+        """Removes all the messages with given IDs within a single transaction.
+        IDs are split into chunks, so each DELETE statement fits SQLite's bound parameters limit."""
+        for i in range(0, len(message_ids), SQLITE_MAX_VARIABLES):
+            chunk: List[int] = message_ids[i:i + SQLITE_MAX_VARIABLES]
+            self.session.query(MessageEntity).filter(MessageEntity.message_id.in_(chunk)).delete(synchronize_session=False)
+        self._commit()
     
     def update_chat_id(self, original_chat_id: int, updated_chat_id: int) -> None:
-        self.session.query(MessageEntity).filter(MessageEntity.chat_id==original_chat_id).update({MessageEntity.chat_id: updated_chat_id})
-        self.session.commit()
+        self._execute_write(_UPDATE_CHAT_ID, {'original_chat_id': original_chat_id, 'updated_chat_id': updated_chat_id})
     
     def get_all_chat_ids(self) -> List[int]:
-        tupled_results = self.session.query(MessageEntity.chat_id.distinct()) 
-        #sqlalchemy returns columns as a list of named tuples (like '[(result_1,), (result_2,)]), so we have to unpack it
-        return [r for (r,) in tupled_results] 
+        cache = self._chat_ids_cache
+        if cache and monotonic() - cache[0] < CHAT_IDS_CACHE_TTL:
+            return list(cache[1])
+        generation: int = self._chat_ids_generation
+        # 'scalars' provides plain values, so there is no need to unpack rows
+        chat_ids: List[int] = list(self.session.scalars(select(MessageEntity.chat_id).distinct()))
+        if generation == self._chat_ids_generation:
+            self._chat_ids_cache = (monotonic(), chat_ids)
+        return list(chat_ids)
+
+    @contextmanager
+    def transaction(self) -> Iterator[None]:
+        """Groups several write operations into a single transaction, so they are committed at once:
+            with repo.transaction():
+                repo.add_messages(messages)
+                repo.update_chat_id(original_chat_id, updated_chat_id)
+        Nested 'transaction' scopes are joined with the outer one."""
+        info = self.session.info
+        if info.get(_TRANSACTION_SCOPE_KEY):
+            yield
+            return
+        info[_TRANSACTION_SCOPE_KEY] = True
+        try:
+            yield
+            self.session.commit()
+        except:
+            self.session.rollback()
+            raise
+        finally:
+            info[_TRANSACTION_SCOPE_KEY] = False
+            self._invalidate_chat_ids_cache()
+
+    def _raw_cursor(self) -> sqlite3.Cursor:
+        """DBAPI cursor of the session's connection: raw SQL executed with it skips ORM and Core overhead,
+        but still is a part of the session's transaction (so it works with the 'transaction' scope and '_commit')."""
+        return self.session.connection().connection.cursor()
+
+    def _in_transaction_scope(self) -> bool:
+        return self.session.info.get(_TRANSACTION_SCOPE_KEY, False)
+
+    def _commit(self) -> None:
+        """Commits the session, unless the write is a part of the 'transaction' scope (it is committed on the scope exit)."""
+        if not self._in_transaction_scope():
+            self.session.commit()
+        self._invalidate_chat_ids_cache()
+
+    def _execute_write(self, statement: Executable, params: Optional[dict] = None) -> int:
+        """Executes Core write statement within the 'transaction' scope if there is one, or right on the engine otherwise.
+        Returns the amount of affected rows."""
+        if self._in_transaction_scope():
+            rowcount: int = self.session.execute(statement, params, execution_options={'synchronize_session': False}).rowcount
+        else:
+            with self.engine.begin() as connection:
+                rowcount: int = connection.execute(statement, params).rowcount
+        self._invalidate_chat_ids_cache()
+        return rowcount
+
+    def _invalidate_chat_ids_cache(self) -> None:
+        """Should be called on every repo modification: the set of chats may be changed."""
+        self._chat_ids_generation += 1
+        self._chat_ids_cache = None
 
-    def remove_outdated_messages(self, date: DateTime) -> None:
-        self.session.query(MessageEntity).filter(MessageEntity.timestamp < date).delete(synchronize_session=False)
-        self.session.commit()
+    def remove_outdated_messages(self, date: Timestamp) -> None:
+        self._execute_write(_DELETE_OUTDATED_MESSAGES, {'date': to_timestamp(date)})
 